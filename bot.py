@@ -1,7 +1,14 @@
 import asyncio
+import atexit
 import logging
 import os
-from datetime import datetime, date
+import queue
+import sys
+import time
+from collections.abc import Awaitable, Callable, Coroutine
+from datetime import date
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
@@ -12,6 +19,7 @@ from dotenv import load_dotenv
 
 from db import (
     init_db,
+    close_db,
     add_expense,
     get_all_expenses,
     get_expenses_by_date,
@@ -21,13 +29,75 @@ from db import (
     delete_all_expenses,
 )
 from utils import parse_expense_message, format_expenses_with_total, format_amount
-from keepalive import start_keepalive_server, start_self_ping
+from keepalive import start_keepalive_server, schedule_self_ping
 
 
 router = Router()
 WELCOME_STICKER_ID = os.getenv("STICKER_WELCOME_ID")
 SUCCESS_STICKER_ID = os.getenv("STICKER_SUCCESS_ID")
 
+_WELCOME_TEXT = (
+    "<b>👋 Assalomu alaykum!</b> Men kundalik xarajatlarni yozib boruvchi botman.\n\n"
+    "<b>Qanday yoziladi?</b>\n"
+    "— Masalan: <b>non 5000</b> yoki <b>qahva 12000</b>\n\n"
+    "<b>Hisobotlar:</b>\n"
+    "• /hisobot — barcha xarajatlar va jami\n"
+    "• /bugun — bugungi xarajatlar va jami\n"
+    "• /oylik — joriy oy jami"
+)
+
+_BOT_COMMANDS = [
+    BotCommand(command="start", description="Botdan foydalanish bo'yicha ma'lumot"),
+    BotCommand(command="hisobot", description="Barcha xarajatlar va jami"),
+    BotCommand(command="bugun", description="Bugungi xarajatlar va jami"),
+    BotCommand(command="oylik", description="Joriy oy jami xarajatlar"),
+    BotCommand(command="menu", description="Menyuni qayta ko'rsatish"),
+    BotCommand(command="help", description="Qisqa yo'riqnoma"),
+    BotCommand(command="undo", description="Oxirgi yozuvni o'chirish"),
+    BotCommand(command="clear", description="Barcha yozuvlarni o'chirish"),
+]
+
+
+# Strong references to fire-and-forget tasks so they are not garbage-collected
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _spawn(coro: Coroutine[Any, Any, Any], error_msg: str) -> asyncio.Task:
+    """Run `coro` in the background, logging `error_msg` if it fails."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+
+    def _done(t: asyncio.Task) -> None:
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logging.error(error_msg, exc_info=t.exception())
+
+    task.add_done_callback(_done)
+    return task
+
+
+# Background expense saves per user, so reads/deletes can wait for them first
+_pending_saves: dict[int, set[asyncio.Task]] = {}
+
+
+def _track_save(user_id: int, task: asyncio.Task) -> None:
+    tasks = _pending_saves.setdefault(user_id, set())
+    tasks.add(task)
+
+    def _done(t: asyncio.Task) -> None:
+        tasks.discard(t)
+        if not tasks and _pending_saves.get(user_id) is tasks:
+            del _pending_saves[user_id]
+
+    task.add_done_callback(_done)
+
+
+async def _wait_pending_saves(user_id: int) -> None:
+    """Wait until this user's acknowledged expenses have reached the database."""
+    tasks = _pending_saves.get(user_id)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 
 def _main_reply_kb() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
@@ -42,24 +112,31 @@ def _main_reply_kb() -> ReplyKeyboardMarkup:
     )
 
 
+# Built once; the keyboard never changes between updates
+_MAIN_REPLY_KB = _main_reply_kb()
+
+# (minute bucket, "YYYY-MM-DD"); date boundaries always fall on a minute boundary
+_today_cache: tuple[float, str] = (-1.0, "")
+
+
+def _today_str() -> str:
+    """Return today's date as YYYY-MM-DD, recomputed at most once a minute."""
+    global _today_cache
+    bucket = time.time() // 60
+    if _today_cache[0] != bucket:
+        _today_cache = (bucket, date.today().strftime("%Y-%m-%d"))
+    return _today_cache[1]
+
+
 @router.message(CommandStart())
 async def cmd_start(message: Message) -> None:
     """Handle /start command: greet and explain usage."""
-    text = (
-        "<b>👋 Assalomu alaykum!</b> Men kundalik xarajatlarni yozib boruvchi botman.\n\n"
-        "<b>Qanday yoziladi?</b>\n"
-        "— Masalan: <b>non 5000</b> yoki <b>qahva 12000</b>\n\n"
-        "<b>Hisobotlar:</b>\n"
-        "• /hisobot — barcha xarajatlar va jami\n"
-        "• /bugun — bugungi xarajatlar va jami\n"
-        "• /oylik — joriy oy jami"
-    )
     if WELCOME_STICKER_ID:
-        try:
-            await message.bot.send_sticker(chat_id=message.chat.id, sticker=WELCOME_STICKER_ID)
-        except Exception:
-            pass
-    await message.answer(text, reply_markup=_main_reply_kb())
+        _spawn(
+            message.bot.send_sticker(chat_id=message.chat.id, sticker=WELCOME_STICKER_ID),
+            "Failed to send welcome sticker",
+        )
+    await message.answer(_WELCOME_TEXT, reply_markup=_MAIN_REPLY_KB)
 
 
 @router.message(Command("hisobot"))
@@ -67,11 +144,12 @@ async def cmd_hisobot(message: Message) -> None:
     """Show all expenses for the user with a total."""
     try:
         user_id = message.from_user.id
-        rows = await get_all_expenses(user_id)
+        await _wait_pending_saves(user_id)
+        rows, total = await get_all_expenses(user_id)
         if not rows:
             await message.answer("🧾 Hali hech qanday xarajat kiritilmagan.")
             return
-        reply = "\n".join(["<b>🧾 Xarajatlaringiz:</b>", format_expenses_with_total(rows)])
+        reply = "\n".join(["<b>🧾 Xarajatlaringiz:</b>", format_expenses_with_total(rows, total)])
         await message.answer(reply)
     except Exception as exc:
         logging.exception("Failed to build /hisobot: %s", exc)
@@ -83,12 +161,13 @@ async def cmd_bugun(message: Message) -> None:
     """Show only today's expenses and total for the user."""
     try:
         user_id = message.from_user.id
-        today = date.today().strftime("%Y-%m-%d")
-        rows = await get_expenses_by_date(user_id, today)
+        await _wait_pending_saves(user_id)
+        today = _today_str()
+        rows, total = await get_expenses_by_date(user_id, today)
         if not rows:
             await message.answer("🧾 Bugun uchun xarajatlar topilmadi.")
             return
-        reply = "\n".join(["<b>🧾 Bugungi xarajatlaringiz:</b>", format_expenses_with_total(rows)])
+        reply = "\n".join(["<b>🧾 Bugungi xarajatlaringiz:</b>", format_expenses_with_total(rows, total)])
         await message.answer(reply)
     except Exception as exc:
         logging.exception("Failed to build /bugun: %s", exc)
@@ -100,6 +179,7 @@ async def cmd_oylik(message: Message) -> None:
     """Show current month's total expenses for the user (sum only)."""
     try:
         user_id = message.from_user.id
+        await _wait_pending_saves(user_id)
         today = date.today()
         total = await get_month_total(user_id, today.year, today.month)
         await message.answer(f"📅 Joriy oy xarajatlari jami: <b>{format_amount(total)}</b>")
@@ -110,7 +190,7 @@ async def cmd_oylik(message: Message) -> None:
 
 @router.message(Command("menu"))
 async def cmd_menu(message: Message) -> None:
-    await message.answer("📋 Menyu yangilandi.", reply_markup=_main_reply_kb())
+    await message.answer("📋 Menyu yangilandi.", reply_markup=_MAIN_REPLY_KB)
 
 
 @router.message(Command("help"))
@@ -123,6 +203,7 @@ async def cmd_undo(message: Message) -> None:
     """Delete the most recently added expense for this user."""
     try:
         user_id = message.from_user.id
+        await _wait_pending_saves(user_id)
         last = await get_last_expense(user_id)
         if not last:
             await message.answer("🗑️ O'chirish uchun yozuv topilmadi.")
@@ -138,38 +219,12 @@ async def cmd_undo(message: Message) -> None:
         await message.answer("Kechirasiz, o'chirishda xatolik yuz berdi.")
 
 
-# ReplyKeyboard button text handlers (before generic text handler)
-@router.message(F.text.in_({"🧾 Hisobot", "Hisobot"}))
-async def rk_hisobot(message: Message) -> None:
-    await cmd_hisobot(message)
-
-
-@router.message(F.text.in_({"📅 Bugun", "Bugun"}))
-async def rk_bugun(message: Message) -> None:
-    await cmd_bugun(message)
-
-
-@router.message(F.text.in_({"📆 Oylik", "Oylik"}))
-async def rk_oylik(message: Message) -> None:
-    await cmd_oylik(message)
-
-
-@router.message(F.text.in_({"↩️ Bekor qilish", "Bekor qilish"}))
-async def rk_cancel(message: Message) -> None:
-    # Behaves like undo: remove the last expense
-    await cmd_undo(message)
-
-
-@router.message(F.text.in_({"🗑️ O'chirish", "O'chirish"}))
-async def rk_delete(message: Message) -> None:
-    await cmd_clear(message)
-
-
 @router.message(Command("clear"))
 async def cmd_clear(message: Message) -> None:
     """Clear all expenses for the current user (reset to zero)."""
     try:
         user_id = message.from_user.id
+        await _wait_pending_saves(user_id)
         removed = await delete_all_expenses(user_id)
         if removed:
             await message.answer(f"🗑️ Barcha xarajatlar o'chirildi. Jami: <b>0 so'm</b> (o'chirildi: {removed})")
@@ -180,6 +235,37 @@ async def cmd_clear(message: Message) -> None:
         await message.answer("Kechirasiz, barcha yozuvlarni o'chirishda xatolik yuz berdi.")
 
 
+# ReplyKeyboard button texts -> command handlers (before generic text handler).
+# One dict lookup instead of a separate filter per button.
+_BUTTON_DISPATCH: dict[str, Callable[[Message], Awaitable[None]]] = {
+    "🧾 Hisobot": cmd_hisobot,
+    "Hisobot": cmd_hisobot,
+    "📅 Bugun": cmd_bugun,
+    "Bugun": cmd_bugun,
+    "📆 Oylik": cmd_oylik,
+    "Oylik": cmd_oylik,
+    # "Bekor qilish" behaves like undo: remove the last expense
+    "↩️ Bekor qilish": cmd_undo,
+    "Bekor qilish": cmd_undo,
+    "🗑️ O'chirish": cmd_clear,
+    "O'chirish": cmd_clear,
+}
+
+
+@router.message(F.text.func(_BUTTON_DISPATCH.__contains__))
+async def handle_reply_button(message: Message) -> None:
+    await _BUTTON_DISPATCH[message.text](message)
+
+
+async def _save_expense(message: Message, user_id: int, item: str, amount: int, date_str: str) -> None:
+    """Store an already-acknowledged expense; tell the chat if saving fails."""
+    try:
+        await add_expense(user_id=user_id, item=item, amount=amount, date_str=date_str)
+    except Exception as exc:
+        logging.exception("Failed to add expense: %s", exc)
+        await message.answer("Kechirasiz, ma'lumotni saqlashda xatolik yuz berdi.")
+
+
 @router.message(F.text)
 async def handle_expense_message(message: Message) -> None:
     """Parse 'item amount' text and store it as an expense record."""
@@ -197,50 +283,94 @@ async def handle_expense_message(message: Message) -> None:
         )
         return
 
-    try:
-        today_str = datetime.now().strftime("%Y-%m-%d")
-        await add_expense(user_id=user_id, item=item, amount=amount, date_str=today_str)
-        if SUCCESS_STICKER_ID:
-            try:
-                await message.bot.send_sticker(chat_id=message.chat.id, sticker=SUCCESS_STICKER_ID)
-            except Exception:
-                pass
-        await message.answer(
-            f"✅ <b>{item}</b> uchun <b>{format_amount(amount)}</b> yozib qo'yildi."
+    today_str = _today_str()
+    # Persist in the background and acknowledge right away
+    save_task = _spawn(
+        _save_expense(message, user_id, item, amount, today_str),
+        "Failed to report expense save error",
+    )
+    _track_save(user_id, save_task)
+    if SUCCESS_STICKER_ID:
+        _spawn(
+            message.bot.send_sticker(chat_id=message.chat.id, sticker=SUCCESS_STICKER_ID),
+            "Failed to send success sticker",
         )
-    except Exception as exc:
-        logging.exception("Failed to add expense: %s", exc)
-        await message.answer("Kechirasiz, ma'lumotni saqlashda xatolik yuz berdi.")
+    await message.answer(
+        f"✅ <b>{item}</b> uchun <b>{format_amount(amount)}</b> yozib qo'yildi."
+    )
 
 
 async def set_bot_commands(bot: Bot) -> None:
-    commands = [
-        BotCommand(command="start", description="Botdan foydalanish bo'yicha ma'lumot"),
-        BotCommand(command="hisobot", description="Barcha xarajatlar va jami"),
-        BotCommand(command="bugun", description="Bugungi xarajatlar va jami"),
-        BotCommand(command="oylik", description="Joriy oy jami xarajatlar"),
-        BotCommand(command="menu", description="Menyuni qayta ko'rsatish"),
-        BotCommand(command="help", description="Qisqa yo'riqnoma"),
-        BotCommand(command="undo", description="Oxirgi yozuvni o'chirish"),
-        BotCommand(command="clear", description="Barcha yozuvlarni o'chirish"),
-    ]
-    await bot.set_my_commands(commands)
+    await bot.set_my_commands(_BOT_COMMANDS)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves all formatting to the listener thread.
+
+    The stock prepare() renders the message and traceback in the caller,
+    i.e. on the event loop. Records stay in-process, so they can be passed as is.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def _setup_logging() -> None:
+    """Route root logging through a queue so handlers run off the event loop."""
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(name)s | %(message)s"))
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [_DeferredQueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    listener.start()
+    # Flush remaining records on interpreter exit
+    atexit.register(listener.stop)
+
+
+async def _sticker_is_valid(bot: Bot, env_name: str, sticker_id: str) -> bool:
+    try:
+        await bot.get_file(sticker_id)
+    except Exception:
+        logging.warning("%s is not a valid sticker file_id; this sticker is disabled", env_name)
+        return False
+    return True
+
+
+async def validate_stickers(bot: Bot) -> None:
+    """Resolve sticker ids from env and disable any that Telegram rejects.
+
+    Checked once at startup so a bad id doesn't cost a failing API call
+    on every /start or saved expense.
+    """
+    global WELCOME_STICKER_ID, SUCCESS_STICKER_ID
+    WELCOME_STICKER_ID = os.getenv("STICKER_WELCOME_ID")
+    SUCCESS_STICKER_ID = os.getenv("STICKER_SUCCESS_ID")
+    if WELCOME_STICKER_ID and not await _sticker_is_valid(bot, "STICKER_WELCOME_ID", WELCOME_STICKER_ID):
+        WELCOME_STICKER_ID = None
+    if SUCCESS_STICKER_ID and not await _sticker_is_valid(bot, "STICKER_SUCCESS_ID", SUCCESS_STICKER_ID):
+        SUCCESS_STICKER_ID = None
 
 
 async def main() -> None:
-    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+    _setup_logging()
     load_dotenv()
     token = os.getenv("BOT_TOKEN")
     if not token:
         raise RuntimeError("BOT_TOKEN is not set. Put it in a .env file.")
 
     # Start lightweight HTTP server for free-hosting keepalive pings
+    ping_task: asyncio.Task | None = None
     try:
         start_keepalive_server()
         keepalive_url = os.getenv("KEEPALIVE_URL")
         if keepalive_url:
             # Optional: self-ping if an external uptime monitor isn't set yet
-            start_self_ping(keepalive_url, int(os.getenv("KEEPALIVE_INTERVAL", "300")))
+            ping_task = schedule_self_ping(
+                asyncio.get_running_loop(), keepalive_url, int(os.getenv("KEEPALIVE_INTERVAL", "300"))
+            )
         logging.info("Keepalive HTTP server started. HEALTH: GET /health")
     except Exception:
         logging.exception("Failed to start keepalive server (non-fatal)")
@@ -251,13 +381,36 @@ async def main() -> None:
     dp = Dispatcher()
     dp.include_router(router)
 
-    await set_bot_commands(bot)
-    logging.info("Bot is starting polling...")
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    try:
+        await set_bot_commands(bot)
+        await validate_stickers(bot)
+        logging.info("Bot is starting polling...")
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        if ping_task is not None:
+            ping_task.cancel()
+        # Let acknowledged expenses reach the database before it is closed
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+        await close_db()
+
+
+def _run(coro: Coroutine[Any, Any, None]) -> None:
+    """Run `coro` on uvloop's event loop when it is available (not on Windows)."""
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(coro)
+        return
+    if sys.version_info >= (3, 12):
+        # uvloop.install() is deprecated on 3.12+
+        asyncio.run(coro, loop_factory=uvloop.new_event_loop)
+    else:
+        uvloop.install()
+        asyncio.run(coro)
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        _run(main())
     except (KeyboardInterrupt, SystemExit):
         print("Bot stopped.")
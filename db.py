@@ -1,37 +1,84 @@
 """SQLite data access layer for the expense bot.
 
-All public functions are async and internally offload blocking sqlite3
-operations to a thread via asyncio.to_thread to keep the event loop responsive.
+All public functions are async and share a single long-lived aiosqlite
+connection opened by `init_db()`, so no per-call file open or thread hop
+through asyncio.to_thread is needed.
 """
 
 from __future__ import annotations
 
-import sqlite3
+import asyncio
 import os
-from contextlib import closing
-from dataclasses import dataclass
-from datetime import date
-from typing import Iterable, List, Sequence, Tuple
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import List, Tuple
 
-import asyncio
+import aiosqlite
 
 
-def _db_path() -> str:
-    """Resolve the database path from env at call time.
+_conn: aiosqlite.Connection | None = None
+# DELETE ... RETURNING needs SQLite 3.35+; older system libraries fall back to SELECT + DELETE
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+# Resolved once by init_db() (after `.env` is loaded) unless set_db_path() ran first
+_DB_PATH: str | None = None
+# aiosqlite already serializes calls per connection; the lock makes write
+# transactions (statement + commit) explicit and non-interleaved.
+_write_lock = asyncio.Lock()
 
-    This ensures `.env`-loaded values are honored even if imported earlier.
-    """
-    return os.getenv("DB_PATH", "expenses.db")
+# add_expense() enqueues rows here; _insert_flusher() commits them in batches
+# so a burst of inserts shares a single transaction (and a single fsync).
+_INSERT_BATCH_MAX = 100
+_INSERT_FLUSH_DELAY = 0.05  # seconds to wait for more rows after the first one
+_InsertParams = Tuple[int, str, int, str, "str | None"]
+_insert_queue: asyncio.Queue[tuple[_InsertParams, asyncio.Future[None]] | None] | None = None
+_flusher_task: asyncio.Task[None] | None = None
+
+# get_month_total() results keyed by (user_id, year, month) -> (expires_at, total).
+# Writes invalidate the affected entries; TTL and LRU size bound staleness and memory.
+_MONTH_TOTAL_TTL = 60.0
+_MONTH_TOTAL_CACHE_MAX = 1024
+_month_total_cache: OrderedDict[Tuple[int, int, int], Tuple[float, int]] = OrderedDict()
+# Bumped on every invalidation so a query that raced a write doesn't cache a stale total
+_month_total_generation = 0
+
+
+def set_db_path(path: str) -> None:
+    """Override the database path. Must be called before `init_db()`."""
+    global _DB_PATH
+    if _conn is not None:
+        raise RuntimeError("set_db_path() must be called before init_db().")
+    _DB_PATH = path
+
+
+def _month_range(year: int, month: int) -> Tuple[str, str]:
+    """Return [start, end) YYYY-MM-DD bounds for an index-friendly month filter."""
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f"{year:04d}-{month:02d}-01", f"{next_year:04d}-{next_month:02d}-01"
+
+
+def _invalidate_month_total(user_id: int, date_str: str) -> None:
+    """Drop the cached total for the month containing `date_str` (YYYY-MM-DD)."""
+    global _month_total_generation
+    _month_total_generation += 1
+    _month_total_cache.pop((user_id, int(date_str[:4]), int(date_str[5:7])), None)
+
+
+def _invalidate_user_month_totals(user_id: int) -> None:
+    global _month_total_generation
+    _month_total_generation += 1
+    for key in [key for key in _month_total_cache if key[0] == user_id]:
+        del _month_total_cache[key]
 
 
-def _connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(_db_path())
-    conn.row_factory = sqlite3.Row
-    return conn
+def _get_conn() -> aiosqlite.Connection:
+    if _conn is None:
+        raise RuntimeError("Database is not initialized. Call init_db() first.")
+    return _conn
 
 
-def _ensure_schema(conn: sqlite3.Connection) -> None:
-    conn.execute(
+async def _ensure_schema(conn: aiosqlite.Connection) -> None:
+    await conn.execute(
         """
         CREATE TABLE IF NOT EXISTS expenses (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -43,175 +90,307 @@ def _ensure_schema(conn: sqlite3.Connection) -> None:
         """
     )
     # Add optional columns if missing
-    cur = conn.execute("PRAGMA table_info(expenses)")
-    cols = {row[1] for row in cur.fetchall()}
+    cols = {row[1] for row in await conn.execute_fetchall("PRAGMA table_info(expenses)")}
     if "category" not in cols:
-        conn.execute("ALTER TABLE expenses ADD COLUMN category TEXT")
-
-
-def _init_db_sync() -> None:
-    with closing(_connect()) as conn, conn:
-        _ensure_schema(conn)
+        await conn.execute("ALTER TABLE expenses ADD COLUMN category TEXT")
+    # Every hot query filters by user_id plus a date (or date range) and orders by id
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_expenses_user_date_id ON expenses(user_id, date, id)"
+    )
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_expenses_user_id_desc ON expenses(user_id, id DESC)"
+    )
+    await conn.commit()
 
 
 async def init_db() -> None:
-    """Create the database/table if not present."""
-    await asyncio.to_thread(_init_db_sync)
+    """Open the shared connection and create the database/table if not present.
 
-
-def _add_expense_sync(user_id: int, item: str, amount: int, date_str: str, category: str | None) -> None:
-    with closing(_connect()) as conn, conn:
-        _ensure_schema(conn)
-        conn.execute(
+    Also starts the background task that batches inserts from add_expense().
+    """
+    global _conn, _insert_queue, _flusher_task, _DB_PATH
+    if _conn is not None:
+        return
+    if _DB_PATH is None:
+        _DB_PATH = os.getenv("DB_PATH", "expenses.db")
+    conn = await aiosqlite.connect(_DB_PATH)
+    await _ensure_schema(conn)
+    # WAL lets /hisobot-style reads proceed while an insert is in flight and
+    # turns each commit into an append; NORMAL sync is durable under WAL.
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute("PRAGMA temp_store=MEMORY")
+    await conn.execute("PRAGMA mmap_size=67108864")
+    await conn.execute("PRAGMA cache_size=-20000")
+    _conn = conn
+    _insert_queue = asyncio.Queue()
+    _flusher_task = asyncio.create_task(_insert_flusher(_insert_queue), name="db-insert-flusher")
+
+
+async def close_db() -> None:
+    """Flush pending inserts and close the shared connection.
+
+    Safe to call if the database was never opened.
+    """
+    global _conn, _insert_queue, _flusher_task
+    if _conn is None:
+        return
+    if _insert_queue is not None and _flusher_task is not None and not _flusher_task.done():
+        # Sentinel: the flusher commits what it has and exits
+        _insert_queue.put_nowait(None)
+        await _flusher_task
+    _insert_queue, _flusher_task = None, None
+    conn, _conn = _conn, None
+    await conn.close()
+
+
+async def _insert_rows(conn: aiosqlite.Connection, rows: List[_InsertParams]) -> None:
+    """Insert and commit `rows` in one transaction; roll back on any error.
+
+    Caller must hold _write_lock.
+    """
+    try:
+        await conn.executemany(
             "INSERT INTO expenses (user_id, item, amount, date, category) VALUES (?, ?, ?, ?, ?)",
-            (user_id, item, amount, date_str, category),
+            rows,
         )
+        await conn.commit()
+    except BaseException:
+        await conn.rollback()
+        raise
+
+
+async def _flush_inserts(batch: List[tuple[_InsertParams, asyncio.Future[None]]]) -> None:
+    conn = _get_conn()
+    saved: List[tuple[_InsertParams, asyncio.Future[None]]] = []
+    async with _write_lock:
+        try:
+            await _insert_rows(conn, [params for params, _fut in batch])
+            saved = batch
+        except Exception as exc:
+            # A get_month_total() that ran before the rollback saw the uncommitted rows
+            for (user_id, _item, _amount, date_str, _category), _fut in batch:
+                _invalidate_month_total(user_id, date_str)
+            if len(batch) == 1:
+                params, fut = batch[0]
+                if not fut.done():
+                    fut.set_exception(exc)
+            else:
+                # One bad row must not fail everyone queued with it: retry row by row
+                for params, fut in batch:
+                    try:
+                        await _insert_rows(conn, [params])
+                    except Exception as row_exc:
+                        _invalidate_month_total(params[0], params[3])
+                        if not fut.done():
+                            fut.set_exception(row_exc)
+                    else:
+                        saved.append((params, fut))
+    for (user_id, _item, _amount, date_str, _category), fut in saved:
+        _invalidate_month_total(user_id, date_str)
+        if not fut.done():
+            fut.set_result(None)
+
+
+async def _insert_flusher(queue: asyncio.Queue[tuple[_InsertParams, asyncio.Future[None]] | None]) -> None:
+    """Drain queued inserts and commit each batch in one transaction.
+
+    However it exits, any rows it did not commit have their futures failed so
+    no add_expense() caller is left waiting.
+    """
+    batch: List[tuple[_InsertParams, asyncio.Future[None]]] = []
+    try:
+        while True:
+            first = await queue.get()
+            if first is None:
+                return
+            # Give concurrent updates a moment to pile up behind the first row
+            await asyncio.sleep(_INSERT_FLUSH_DELAY)
+            batch = [first]
+            stop = False
+            while len(batch) < _INSERT_BATCH_MAX and not queue.empty():
+                entry = queue.get_nowait()
+                if entry is None:
+                    stop = True
+                    break
+                batch.append(entry)
+            await _flush_inserts(batch)
+            batch = []
+            if stop:
+                return
+    finally:
+        while not queue.empty():
+            entry = queue.get_nowait()
+            if entry is not None:
+                batch.append(entry)
+        for _params, fut in batch:
+            if not fut.done():
+                fut.set_exception(RuntimeError("Insert flusher stopped before the row was saved."))
 
 
 async def add_expense(user_id: int, item: str, amount: int, date_str: str, category: str | None = None) -> None:
-    """Add a single expense record to the database."""
-    await asyncio.to_thread(_add_expense_sync, user_id, item, amount, date_str, category)
-
-
-def _get_all_expenses_sync(user_id: int) -> List[Tuple[str, int, str]]:
-    with closing(_connect()) as conn:
-        _ensure_schema(conn)
-        cur = conn.execute(
-            "SELECT item, amount, date FROM expenses WHERE user_id = ? ORDER BY id ASC",
-            (user_id,),
-        )
-        return [(row["item"], int(row["amount"]), row["date"]) for row in cur.fetchall()]
-
-
-async def get_all_expenses(user_id: int) -> List[Tuple[str, int, str]]:
-    """Return all expenses as (item, amount, date)."""
-    return await asyncio.to_thread(_get_all_expenses_sync, user_id)
+    """Add a single expense record to the database.
 
+    The row is committed together with any other inserts queued within a
+    short window; this returns once that batch is committed and re-raises
+    any database error.
+    """
+    if _insert_queue is None or _flusher_task is None:
+        raise RuntimeError("Database is not initialized. Call init_db() first.")
+    if _flusher_task.done():
+        raise RuntimeError("Insert flusher is not running; the database is closing or failed.")
+    fut: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+    # put_nowait (unbounded queue) so nothing can slip in between the check and the enqueue
+    _insert_queue.put_nowait(((user_id, item, amount, date_str, category), fut))
+    await fut
 
-def _get_expenses_by_date_sync(user_id: int, date_str: str) -> List[Tuple[str, int, str]]:
-    with closing(_connect()) as conn:
-        _ensure_schema(conn)
-        cur = conn.execute(
-            """
-            SELECT item, amount, date
-            FROM expenses
-            WHERE user_id = ? AND date = ?
-            ORDER BY id ASC
-            """,
-            (user_id, date_str),
-        )
-        return [(row["item"], int(row["amount"]), row["date"]) for row in cur.fetchall()]
 
+async def get_all_expenses(user_id: int) -> Tuple[List[Tuple[str, int, str]], int]:
+    """Return all expenses as (item, amount, date) rows plus their total.
 
-async def get_expenses_by_date(user_id: int, date_str: str) -> List[Tuple[str, int, str]]:
-    """Return expenses for a user for a specific YYYY-MM-DD date."""
-    return await asyncio.to_thread(_get_expenses_by_date_sync, user_id, date_str)
+    The total is computed by SQLite in the same scan (window SUM).
+    """
+    rows = await _get_conn().execute_fetchall(
+        """
+        SELECT item, amount, date, SUM(amount) OVER () AS total
+        FROM expenses
+        WHERE user_id = ?
+        ORDER BY id ASC
+        """,
+        (user_id,),
+    )
+    total = int(rows[0][3]) if rows else 0
+    return [(item, int(amount), d) for (item, amount, d, _total) in rows], total
 
 
-def _get_month_total_sync(user_id: int, year: int, month: int) -> int:
-    ym_prefix = f"{year:04d}-{month:02d}-"
-    with closing(_connect()) as conn:
-        _ensure_schema(conn)
-        cur = conn.execute(
-            "SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE user_id = ? AND date LIKE ?",
-            (user_id, f"{ym_prefix}%"),
-        )
-        row = cur.fetchone()
-        return int(row[0] or 0)
+async def get_expenses_by_date(user_id: int, date_str: str) -> Tuple[List[Tuple[str, int, str]], int]:
+    """Return expenses for a user for a specific YYYY-MM-DD date plus their total."""
+    rows = await _get_conn().execute_fetchall(
+        """
+        SELECT item, amount, date, SUM(amount) OVER () AS total
+        FROM expenses
+        WHERE user_id = ? AND date = ?
+        ORDER BY id ASC
+        """,
+        (user_id, date_str),
+    )
+    total = int(rows[0][3]) if rows else 0
+    return [(item, int(amount), d) for (item, amount, d, _total) in rows], total
 
 
 async def get_month_total(user_id: int, year: int, month: int) -> int:
-    """Return total expenses for a user's given year-month."""
-    return await asyncio.to_thread(_get_month_total_sync, user_id, year, month)
-
-
-def _get_expenses_by_month_sync(user_id: int, year: int, month: int) -> List[Tuple[int, str, int, str, str | None]]:
-    ym_prefix = f"{year:04d}-{month:02d}-"
-    with closing(_connect()) as conn:
-        _ensure_schema(conn)
-        cur = conn.execute(
-            """
-            SELECT id, item, amount, date, category
-            FROM expenses
-            WHERE user_id = ? AND date LIKE ?
-            ORDER BY date ASC, id ASC
-            """,
-            (user_id, f"{ym_prefix}%"),
-        )
-        return [
-            (int(row["id"]), row["item"], int(row["amount"]), row["date"], row["category"])  # type: ignore[index]
-            for row in cur.fetchall()
-        ]
+    """Return total expenses for a user's given year-month.
+
+    Served from a short-lived cache that writes for the user invalidate.
+    """
+    key = (user_id, year, month)
+    now = time.monotonic()
+    cached = _month_total_cache.get(key)
+    if cached is not None and cached[0] > now:
+        _month_total_cache.move_to_end(key)
+        return cached[1]
+
+    generation = _month_total_generation
+    start, end = _month_range(year, month)
+    rows = await _get_conn().execute_fetchall(
+        "SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE user_id = ? AND date >= ? AND date < ?",
+        (user_id, start, end),
+    )
+    total = int(rows[0][0] or 0) if rows else 0
+    if generation == _month_total_generation:
+        _month_total_cache[key] = (now + _MONTH_TOTAL_TTL, total)
+        _month_total_cache.move_to_end(key)
+        while len(_month_total_cache) > _MONTH_TOTAL_CACHE_MAX:
+            _month_total_cache.popitem(last=False)
+    return total
 
 
 async def get_expenses_by_month(user_id: int, year: int, month: int) -> List[Tuple[int, str, int, str, str | None]]:
     """Return all expense rows for the given year-month."""
-    return await asyncio.to_thread(_get_expenses_by_month_sync, user_id, year, month)
-
-
-def _get_last_expense_sync(user_id: int) -> Tuple[int, str, int, str, str | None] | None:
-    with closing(_connect()) as conn:
-        _ensure_schema(conn)
-        cur = conn.execute(
-            "SELECT id, item, amount, date, category FROM expenses WHERE user_id = ? ORDER BY id DESC LIMIT 1",
-            (user_id,),
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-        return (int(row["id"]), row["item"], int(row["amount"]), row["date"], row["category"])  # type: ignore[index]
+    start, end = _month_range(year, month)
+    rows = await _get_conn().execute_fetchall(
+        """
+        SELECT id, item, amount, date, category
+        FROM expenses
+        WHERE user_id = ? AND date >= ? AND date < ?
+        ORDER BY date ASC, id ASC
+        """,
+        (user_id, start, end),
+    )
+    return [
+        (int(exp_id), item, int(amount), d, category)
+        for (exp_id, item, amount, d, category) in rows
+    ]
 
 
 async def get_last_expense(user_id: int) -> Tuple[int, str, int, str, str | None] | None:
-    return await asyncio.to_thread(_get_last_expense_sync, user_id)
-
-
-def _delete_expense_sync(user_id: int, expense_id: int) -> int:
-    with closing(_connect()) as conn, conn:
-        _ensure_schema(conn)
-        cur = conn.execute(
-            "DELETE FROM expenses WHERE user_id = ? AND id = ?",
-            (user_id, expense_id),
-        )
-        return cur.rowcount or 0
+    rows = await _get_conn().execute_fetchall(
+        "SELECT id, item, amount, date, category FROM expenses WHERE user_id = ? ORDER BY id DESC LIMIT 1",
+        (user_id,),
+    )
+    if not rows:
+        return None
+    exp_id, item, amount, d, category = rows[0]
+    return (int(exp_id), item, int(amount), d, category)
 
 
 async def delete_expense(user_id: int, expense_id: int) -> int:
     """Delete one expense for user by id. Returns number of rows removed (0 or 1)."""
-    return await asyncio.to_thread(_delete_expense_sync, user_id, expense_id)
-
-
-def _get_month_category_totals_sync(user_id: int, year: int, month: int) -> List[Tuple[str, int]]:
-    ym_prefix = f"{year:04d}-{month:02d}-"
-    with closing(_connect()) as conn:
-        _ensure_schema(conn)
-        cur = conn.execute(
-            """
-            SELECT COALESCE(NULLIF(category, ''), 'Boshqa') AS cat, COALESCE(SUM(amount), 0) AS total
-            FROM expenses
-            WHERE user_id = ? AND date LIKE ?
-            GROUP BY cat
-            ORDER BY total DESC
-            """,
-            (user_id, f"{ym_prefix}%"),
-        )
-        return [(row[0], int(row[1])) for row in cur.fetchall()]
+    conn = _get_conn()
+    async with _write_lock:
+        try:
+            if _HAS_RETURNING:
+                rows = await conn.execute_fetchall(
+                    "DELETE FROM expenses WHERE user_id = ? AND id = ? RETURNING date",
+                    (user_id, expense_id),
+                )
+            else:
+                rows = await conn.execute_fetchall(
+                    "SELECT date FROM expenses WHERE user_id = ? AND id = ?",
+                    (user_id, expense_id),
+                )
+                if rows:
+                    await conn.execute(
+                        "DELETE FROM expenses WHERE user_id = ? AND id = ?",
+                        (user_id, expense_id),
+                    )
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+    for (date_str,) in rows:
+        _invalidate_month_total(user_id, date_str)
+    return len(rows)
 
 
 async def get_month_category_totals(user_id: int, year: int, month: int) -> List[Tuple[str, int]]:
-    return await asyncio.to_thread(_get_month_category_totals_sync, user_id, year, month)
-
-
-def _delete_all_expenses_sync(user_id: int) -> int:
-    with closing(_connect()) as conn, conn:
-        _ensure_schema(conn)
-        cur = conn.execute(
-            "DELETE FROM expenses WHERE user_id = ?",
-            (user_id,),
-        )
-        return cur.rowcount or 0
+    start, end = _month_range(year, month)
+    rows = await _get_conn().execute_fetchall(
+        """
+        SELECT COALESCE(NULLIF(category, ''), 'Boshqa') AS cat, COALESCE(SUM(amount), 0) AS total
+        FROM expenses
+        WHERE user_id = ? AND date >= ? AND date < ?
+        GROUP BY cat
+        ORDER BY total DESC
+        """,
+        (user_id, start, end),
+    )
+    return [(cat, int(total)) for (cat, total) in rows]
 
 
 async def delete_all_expenses(user_id: int) -> int:
     """Delete all expenses for a user. Returns number of rows removed."""
-    return await asyncio.to_thread(_delete_all_expenses_sync, user_id)
+    conn = _get_conn()
+    async with _write_lock:
+        try:
+            await conn.execute(
+                "DELETE FROM expenses WHERE user_id = ?",
+                (user_id,),
+            )
+            rows = await conn.execute_fetchall("SELECT changes()")
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+    _invalidate_user_month_totals(user_id)
+    return int(rows[0][0]) if rows else 0
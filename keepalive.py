@@ -1,23 +1,33 @@
+import asyncio
 import os
 import threading
-import time
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.request import urlopen
-from urllib.error import URLError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+
+
+_HEALTH_PATHS = frozenset(("/", "/health", "/ping"))
+# Full raw responses, sent with a single write instead of one per header
+_RESP_OK = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Length: 2\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b"OK"
+)
+_RESP_NOT_FOUND = (
+    b"HTTP/1.1 404 Not Found\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+)
 
 
 class _HealthHandler(BaseHTTPRequestHandler):
     def do_GET(self):  # noqa: N802 (http.server API)
-        if self.path in ("/", "/health", "/ping"):
-            body = b"OK"
-            self.send_response(200)
-            self.send_header("Content-Type", "text/plain; charset=utf-8")
-            self.send_header("Content-Length", str(len(body)))
-            self.end_headers()
-            self.wfile.write(body)
-        else:
-            self.send_response(404)
-            self.end_headers()
+        self.close_connection = True
+        self.wfile.write(_RESP_OK if self.path in _HEALTH_PATHS else _RESP_NOT_FOUND)
 
     # Silence default logging to stderr
     def log_message(self, format: str, *args) -> None:  # noqa: A003
@@ -38,7 +48,7 @@ def start_keepalive_server() -> threading.Thread:
     except ValueError:
         port = 8080
 
-    httpd = HTTPServer((host, port), _HealthHandler)
+    httpd = ThreadingHTTPServer((host, port), _HealthHandler)
 
     def _serve():
         try:
@@ -52,29 +62,33 @@ def start_keepalive_server() -> threading.Thread:
     return t
 
 
-def start_self_ping(url: str, interval_seconds: int = 300) -> threading.Thread:
-    """Start a background thread that pings the given URL periodically.
+def schedule_self_ping(
+    loop: asyncio.AbstractEventLoop, url: str, interval_seconds: int = 300
+) -> asyncio.Task:
+    """Schedule a task on `loop` that pings the given URL periodically.
 
     Useful to keep free hosting platforms warm. If the request fails,
-    it silently retries on the next interval.
+    it silently retries on the next interval. Keep a reference to the
+    returned task for as long as pinging should continue.
     """
+    return loop.create_task(_ping_loop(url, interval_seconds), name="keepalive-ping")
 
-    def _loop():
-        # Small initial delay to allow the app to bind the port
-        time.sleep(5)
+
+async def _ping_loop(url: str, interval_seconds: int) -> None:
+    # Small initial delay to allow the app to bind the port
+    await asyncio.sleep(5)
+    timeout = aiohttp.ClientTimeout(total=10)
+    # One pooled connection with a long keepalive so pings reuse TCP/TLS
+    connector = aiohttp.TCPConnector(limit=1, keepalive_timeout=600)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
         while True:
             try:
-                with urlopen(url, timeout=10) as resp:
-                    # Drain response to let the server count the hit
-                    resp.read(64)
-            except URLError:
-                pass
+                async with session.get(url) as resp:
+                    # Read the whole body so the connection goes back to the pool
+                    await resp.read()
+            except asyncio.CancelledError:
+                raise
             except Exception:
-                # Never crash the thread
+                # Never crash the loop
                 pass
-            time.sleep(max(30, int(interval_seconds)))
-
-    t = threading.Thread(target=_loop, name="keepalive-ping", daemon=True)
-    t.start()
-    return t
-
+            await asyncio.sleep(max(30, int(interval_seconds)))
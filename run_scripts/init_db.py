@@ -7,11 +7,12 @@ PROJECT_ROOT = os.path.dirname(CURRENT_DIR)
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
-from db import init_db
+from db import init_db, close_db
 
 
 async def main():
     await init_db()
+    await close_db()
     print("DB initialized OK")
 
 
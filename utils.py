@@ -2,7 +2,10 @@
 
 from __future__ import annotations
 
-from typing import List, Sequence, Tuple
+from typing import Sequence, Tuple
+
+# Largest value SQLite can store in an INTEGER column
+_MAX_AMOUNT = 2**63 - 1
 
 
 def parse_expense_message(text: str) -> tuple[str, int]:
@@ -11,38 +14,55 @@ def parse_expense_message(text: str) -> tuple[str, int]:
     if not s:
         raise ValueError("Matn bo'sh bo'lmasligi kerak.")
 
-    parts = s.split()
-    if len(parts) < 2:
-        raise ValueError("Format: 'mahsulot summasi' (masalan: 'non 5000').")
-
-    amount_str = parts[-1]
-    item = " ".join(parts[:-1]).strip()
+    # Fast path: "item amount" separated by single spaces needs no list or join.
+    # isprintable() is False for every whitespace char except the ASCII space.
+    item, sep, amount_str = s.rpartition(" ")
+    if (
+        not sep
+        or item.endswith(" ")
+        or "  " in item
+        or not item.isprintable()
+        or not amount_str.isprintable()
+    ):
+        # Other whitespace or runs of spaces: split and normalise like str.split()
+        parts = s.rsplit(None, 1)
+        if len(parts) < 2:
+            raise ValueError("Format: 'mahsulot summasi' (masalan: 'non 5000').")
+        item, amount_str = parts
+        item = " ".join(item.split())
     if not amount_str.isdigit():
         raise ValueError("Summani butun son ko'rinishida yozing (masalan: 12000).")
 
     amount = int(amount_str)
     if amount < 0:
         raise ValueError("Summaning qiymati manfiy bo'lmasligi kerak.")
+    if amount > _MAX_AMOUNT:
+        raise ValueError("Summa juda katta.")
     if not item:
         raise ValueError("Mahsulot nomi ko'rsatilmagan.")
 
     return item, amount
 
 
+_COMMA_TO_SPACE = str.maketrans(",", " ")
+_CURRENCY_SUFFIX = " so'm"
+
+
 def format_amount(amount: int) -> str:
     """Format amount in so'm with thousands separators."""
-    return f"{amount:,} so'm".replace(",", " ")
+    return format(amount, ",").translate(_COMMA_TO_SPACE) + _CURRENCY_SUFFIX
 
 
-def format_expenses_with_total(rows: Sequence[Tuple[str, int, str]]) -> str:
-    """Format (item, amount, date) into a readable list plus total.
+def format_expenses_with_total(rows: Sequence[Tuple[str, int, str]], total: int) -> str:
+    """Format (item, amount, date) into a readable list plus a precomputed total.
 
     - Item nomi va summa qalin ko'rinishda chiqadi.
     """
-    lines: List[str] = []
-    total = 0
-    for item, amount, _date in rows:
-        total += int(amount)
-        lines.append(f"<b>{item}</b> — <b>{format_amount(int(amount))}</b>")
-    lines.append(f"💰 Jami: <b>{format_amount(total)}</b>")
-    return "\n".join(lines)
+    total_line = f"💰 Jami: <b>{format_amount(total)}</b>"
+    if not rows:
+        return total_line
+    body = "\n".join(
+        f"<b>{item}</b> — <b>{format_amount(int(amount))}</b>"
+        for item, amount, _date in rows
+    )
+    return f"{body}\n{total_line}"